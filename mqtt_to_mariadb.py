@@ -1,9 +1,21 @@
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import mysql.connector
+import mysql.connector.pooling
 from dotenv import dotenv_values
 import ssl
-import json
+import socket
+import orjson
 import time
+import datetime
+import threading
+import queue
+import logging
+import logging.handlers
+import sys
+import multiprocessing
+import signal
 
 """
 MQTT to MariaDB Logger
@@ -13,8 +25,9 @@ and logs them into a MariaDB/MySQL database.
 
 Key Features:
 - Dynamic Table Creation: Tables are created automatically based on the MQTT topic.
-- Dynamic Schema: Columns are created based on the keys in the JSON payload.
-- Type Inference: Maps Python types (str, int, float) to SQL types (VARCHAR, DECIMAL).
+- Dynamic Schema: Columns are created based on the keys in the JSON payload,
+  and added with ALTER TABLE when new keys appear later.
+- Type Inference: Maps Python types (bool, int, float, str) to SQL types (TINYINT, DOUBLE, VARCHAR).
 """
 
 # --- Configuration Loading ---
@@ -22,22 +35,154 @@ Key Features:
 # DB_NAME, MQTT_BROKER_HOST, MQTT_BROKER_PORT, and MQTT_TOPIC_SUBSCRIPTION.
 CONFIG = dotenv_values(".config")
 
+logger = logging.getLogger("mqtt_to_mariadb")
+
+# Connection pool shared by the DB worker threads (created once at startup).
+DB_POOL = None
+
+# Insert batching: each worker flushes its rows every BATCH_INTERVAL seconds,
+# or earlier once a single (table, keys) group holds BATCH_SIZE rows.
+BATCH_SIZE = int(CONFIG.get("DB_BATCH_SIZE", 500))
+BATCH_INTERVAL = float(CONFIG.get("DB_BATCH_INTERVAL", 0.2))
+
+# Messages are handed from the Paho network thread to DB_WORKERS worker
+# threads through a bounded queue, so on_message never waits for the database.
+DB_WORKERS = int(CONFIG.get("DB_WORKERS", 4))
+MESSAGE_QUEUE = queue.Queue(maxsize=int(CONFIG.get("MESSAGE_QUEUE_SIZE", 10000)))
+
+# QoS level of the subscriptions, checked at startup rather than in on_connect
+MQTT_QOS = int(CONFIG.get("MQTT_QOS") or 0)
+if MQTT_QOS not in (0, 1, 2):
+    raise ValueError(f"MQTT_QOS must be 0, 1 or 2, got {MQTT_QOS}")
+
+# Seconds the broker keeps the MQTT session after a disconnect (default 1 hour)
+SESSION_EXPIRY = int(CONFIG.get("MQTT_SESSION_EXPIRY") or 3600)
+
+# Receive buffer size of the MQTT socket in bytes. 0 (default) leaves it to the
+# kernel, as a fixed SO_RCVBUF disables Linux receive-buffer autotuning
+SOCKET_RCVBUF = int(CONFIG.get("MQTT_SOCKET_RCVBUF", 0))
+
+# Number of messages dropped because the queue was full
+DROPPED_MESSAGES = 0
+
+# Extra options for new tables, e.g. 'ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8' to cut
+# disk usage (opt-in: compressed tables are rebuilt on every ADD COLUMN)
+TABLE_OPTIONS = CONFIG.get("DB_TABLE_OPTIONS", "")
+
+# Tables known to exist, so CREATE TABLE runs at most once per table
+KNOWN_TABLES = set()
+
+# table_name -> lower-cased column names, loaded from INFORMATION_SCHEMA on first
+# touch, so ALTER TABLE runs at most once per new JSON key
+TABLE_COLS = {}
+
+# table_name -> lock serializing CREATE/ALTER TABLE for that table only, so a
+# slow ALTER does not stall flushes to other tables. SCHEMA_LOCK only guards the dict.
+TABLE_LOCKS = {}
+SCHEMA_LOCK = threading.Lock()
+
+# (table_name, sorted JSON keys) -> INSERT statement, built once per schema signature
+STMT_CACHE = {}
+
+# (topic, JSON keys in payload order) -> (table_name, sorted JSON keys).
+# The payload shape per topic is practically fixed, so this is resolved once.
+SCHEMA_CACHE = {}
+
+# Value-level error codes that MySQL reports with SQLSTATE HY000/01000 instead of
+# class 22 (DataError): 1265 'Data truncated', 1366 'Incorrect ... value'
+VALUE_ERRNOS = {1265, 1366}
+
+# Single-pass translation tables for table and column name sanitization
+_TOPIC_TRANS = str.maketrans({'/': '_', '+': None})
+_SANITIZE = str.maketrans({'.': '_', '-': '_'})
+
+
+# --- Logging ---
+
+def setup_logging(show_process=False):
+    """
+    Routes all log records through a queue to a background listener thread,
+    so writing to stdout/journal never blocks the MQTT or DB worker threads.
+
+    Args:
+        show_process (bool): Prefix lines with the process name (used for shards).
+
+    Returns:
+        QueueListener: The started listener (stop it on shutdown to flush).
+    """
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(
+        "[%(processName)s] %(message)s" if show_process else "%(message)s"
+    ))
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    # Per-batch success lines are DEBUG; set LOG_LEVEL=DEBUG to see them
+    root.setLevel(CONFIG.get("LOG_LEVEL", "INFO").upper())
+
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
 
 # --- Database / Helper Functions ---
 
-def connect_db():
-    """Establishes and returns a connection to the MariaDB/MySQL database."""
+def create_db_pool():
+    """
+    Creates the MariaDB/MySQL connection pool used for all inserts.
+
+    Connections are opened once and reused, so a message only pays for the
+    INSERT round-trip instead of a full TCP/TLS/auth handshake.
+
+    Returns:
+        MySQLConnectionPool or None: The pool, or None if it could not be created.
+    """
+    if not mysql.connector.HAVE_CEXT:
+        logger.warning("mysql-connector C extension not available, using the slower pure Python protocol.")
+
+    # Every DB worker keeps one INSERT in flight, so never size the pool below DB_WORKERS
+    pool_size = max(int(CONFIG.get("DB_POOL_SIZE", 8)), DB_WORKERS)
+    if pool_size > mysql.connector.pooling.CNX_POOL_MAXSIZE:
+        logger.error(
+            "DB_POOL_SIZE and DB_WORKERS must not exceed %d (mysql-connector pool limit), got %d.",
+            mysql.connector.pooling.CNX_POOL_MAXSIZE, pool_size
+        )
+        return None
+
     try:
-        db = mysql.connector.connect(
+        pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name="mqtt",
+            pool_size=pool_size,
+            # Skip the session reset round-trip when a connection is returned
+            pool_reset_session=False,
+            # Already the default when the C extension is installed; made explicit here
+            use_pure=False,
+            # Every statement commits on its own; batches use explicit transactions
+            autocommit=True,
+            # Receive times are passed as UTC, independent of the DB server's time zone
+            time_zone="+00:00",
             host=CONFIG.get("DB_HOST", "localhost"),
             port=CONFIG.get("DB_PORT", 3306),
             user=CONFIG["DB_USER"],
             password=CONFIG["DB_PASSWORD"],
             database=CONFIG["DB_NAME"]
         )
-        return db
+        return pool
     except mysql.connector.Error as err:
-        print(f"Error connecting to MariaDB: {err}")
+        logger.error("Error creating MariaDB connection pool: %s", err)
+        return None
+
+
+def connect_db():
+    """
+    Returns a pooled connection to the MariaDB/MySQL database.
+    Calling close() on the connection hands it back to the pool.
+    """
+    try:
+        return DB_POOL.get_connection()
+    except mysql.connector.Error as err:
+        logger.error("Error getting connection from MariaDB pool: %s", err)
         return None
 
 
@@ -47,35 +192,27 @@ def topic_to_table_name(topic):
     Preserves case sensitivity.
     """
     # Replaces slashes with underscores and removes plus signs
-    return topic.replace('/', '_').replace('+', '')
+    return topic.translate(_TOPIC_TRANS)
 
 
-def table_exists(cursor, table_name):
-    """
-    Checks if a given table exists in the current database.
-
-    Args:
-        cursor: The database cursor.
-        table_name (str): Name of the table to check.
+def load_known_tables():
+    """Primes KNOWN_TABLES with the tables that already exist in the database."""
+    db_conn = connect_db()
+    if db_conn is None:
+        return
 
-    Returns:
-        bool: True if table exists, False otherwise.
-    """
+    cursor = None
     try:
-        # Executes a SELECT statement to check for table existence
-        cursor.execute(f"SELECT 1 FROM `{table_name}` LIMIT 1;")
-
-        # IMPORTANT: The result must be consumed (fetched),
-        # otherwise it blocks the next INSERT command (Unread result found error)!
-        cursor.fetchone()
-
-        return True
+        cursor = db_conn.cursor()
+        cursor.execute("SHOW TABLES;")
+        KNOWN_TABLES.update(row[0] for row in cursor.fetchall())
+        logger.info("Found %d existing table(s).", len(KNOWN_TABLES))
     except mysql.connector.Error as err:
-        # Error code 1146 means 'Table doesn't exist'
-        if err.errno == 1146:
-            return False
-        print(f"Error checking table existence for '{table_name}': {err}")
-        return False
+        logger.error("Error listing existing tables: %s", err)
+    finally:
+        if cursor:
+            cursor.close()
+        db_conn.close()
 
 
 def python_type_to_sql(value):
@@ -88,32 +225,42 @@ def python_type_to_sql(value):
     Returns:
         str: The corresponding SQL data type definition.
     """
-    if isinstance(value, (int, float)):
-        # DECIMALS provide better precision for sensor values than FLOAT
-        return "DECIMAL(10, 4)"
-    elif isinstance(value, str):
+    if isinstance(value, bool):
+        # Checked before int, as bool is a subclass of int
+        return "TINYINT(1)"
+    elif isinstance(value, (int, float)):
+        # One type for ints and floats, as the type is inferred from the first
+        # message only (22 may be followed by 22.5). DOUBLE is exact for
+        # integers up to 2^53, which covers epoch timestamps and counters.
+        return "DOUBLE"
+    elif isinstance(value, str) and len(value) <= 255:
         # VARCHAR for text status, names, IDs, etc.
         return "VARCHAR(255)"
     else:
-        # Fallback for lists, booleans, dicts, etc., which are saved as text
+        # Fallback for long strings, lists, dicts, etc., which are saved as text
         return "TEXT"
 
 
 def create_dynamic_table(cursor, table_name, data):
     """
     Creates a new table based on the keys and determined types from the JSON data.
+    Uses CREATE TABLE IF NOT EXISTS, so an existing table is left untouched and
+    no separate existence check is needed.
 
     Args:
         cursor: The database cursor.
         table_name (str): The name of the table to create.
         data (dict): The JSON data dictionary to derive the schema from.
+
+    Returns:
+        bool: True if the table exists afterwards, False on error.
     """
     dynamic_columns = []
 
     # 1. Collect column definitions based on the data
     for key, value in data.items():
         # Sanitize column names (replace dots and dashes with underscores)
-        safe_key = key.replace('.', '_').replace('-', '_')
+        safe_key = key.translate(_SANITIZE)
 
         # Determine the appropriate SQL type based on the value's type
         sql_type = python_type_to_sql(value)
@@ -122,130 +269,536 @@ def create_dynamic_table(cursor, table_name, data):
         dynamic_columns.append(f"`{safe_key}` {sql_type} NULL")
 
     # 2. Assemble the complete CREATE statement
-    columns_definition = ", ".join(dynamic_columns)
+    # Index for per-sensor time range queries, so reads stay fast as the table grows
+    columns_definition = ", ".join(dynamic_columns + ["KEY idx_sensor_ts (sensor_id, timestamp)"])
 
     create_query = f"""
-    CREATE TABLE `{table_name}` (
+    CREATE TABLE IF NOT EXISTS `{table_name}` (
         id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
         timestamp TIMESTAMP NOT NULL,
         sensor_id VARCHAR(100) NOT NULL,
         {columns_definition}
-    );
+    ) ENGINE=InnoDB {TABLE_OPTIONS};
     """
 
     try:
         cursor.execute(create_query)
-        print(f" -> NEW TABLE created: '{table_name}'. Schema: {columns_definition}")
+        # A warning (1050) means the table already existed
+        if not cursor.warning_count:
+            logger.info(" -> NEW TABLE created: '%s'. Schema: %s", table_name, columns_definition)
         return True
     except mysql.connector.Error as err:
-        print(f" -> ERROR creating table '{table_name}': {err}")
+        logger.error(" -> ERROR creating table '%s': %s", table_name, err)
         return False
 
 
-# --- MQTT Callbacks ---
+def load_table_columns(cursor, table_name):
+    """
+    Reads the column names of a table from INFORMATION_SCHEMA.
 
-def on_connect(client, userdata, flags, reason_code, properties):
-    """Callback function when the client connects to the broker (Paho V2)."""
-    if reason_code == 0:
-        print("Connected to MQTT Broker successfully.")
-        topic = CONFIG["MQTT_TOPIC_SUBSCRIPTION"]
-        # Subscribe to the wildcard topic (e.g., 'Sensoren/#')
-        client.subscribe(topic)
-        print(f"Subscribed to topic: {topic}")
-    else:
-        print(f"Failed to connect, return code {reason_code}")
+    Returns:
+        set: The lower-cased column names (MariaDB column names are case-insensitive).
+    """
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s;",
+        (table_name,)
+    )
+    return {row[0].lower() for row in cursor.fetchall()}
 
 
-def on_message(client, userdata, msg):
+def add_missing_columns(cursor, table_name, data):
     """
-    Callback function when a message is received.
-    Parses JSON, checks/creates table, and inserts data.
+    Adds columns for JSON keys that the table does not have yet.
+
+    All new columns are added with a single ALTER TABLE statement; the known
+    column set is cached in TABLE_COLS, so this is a set lookup per key once
+    the schema is stable.
+
+    Args:
+        cursor: The database cursor.
+        table_name (str): The table to extend.
+        data (dict): The JSON data dictionary to derive new columns from.
+
+    Returns:
+        bool: True if the table has all columns afterwards, False on error.
     """
-    topic = msg.topic
+    known = TABLE_COLS.get(table_name)
+    if known is None:
+        known = TABLE_COLS[table_name] = load_table_columns(cursor, table_name)
+
+    new_columns = {}
+    for key, value in data.items():
+        safe_key = key.translate(_SANITIZE)
+        if safe_key.lower() not in known:
+            new_columns[safe_key.lower()] = f"ADD COLUMN `{safe_key}` {python_type_to_sql(value)} NULL"
 
-    # 1. Decode payload and parse JSON (Mandatory check)
+    if not new_columns:
+        return True
+
+    alter_query = f"ALTER TABLE `{table_name}` {', '.join(new_columns.values())};"
     try:
-        payload_str = msg.payload.decode("utf-8")
-        data = json.loads(payload_str)
+        cursor.execute(alter_query)
+        known.update(new_columns)
+        logger.info(" -> NEW COLUMNS added to '%s': %s", table_name, ", ".join(new_columns))
+        return True
+    except mysql.connector.Error as err:
+        # e.g. 1060 'Duplicate column name' if another process added it first;
+        # reload the column set on the next flush
+        TABLE_COLS.pop(table_name, None)
+        logger.error(" -> ERROR adding columns to '%s': %s", table_name, err)
+        return False
 
-    except json.JSONDecodeError:
+
+# --- Batched Inserts ---
+
+def build_insert_query(table_name, columns):
+    """
+    Builds the INSERT statement for a table and an ordered set of JSON keys.
+
+    Args:
+        table_name (str): The target table.
+        columns (tuple): The JSON keys in the order their values are passed.
+
+    Returns:
+        str: The parameterized INSERT statement.
+    """
+    # Base columns that are always present. The timestamp is passed as a
+    # parameter (not NOW()), so executemany() can send one multi-row INSERT.
+    insert_columns = ['timestamp', 'sensor_id']
+    insert_values = ['%s', '%s']
+
+    # Add dynamic columns from the JSON payload
+    for key in columns:
+        safe_key = key.translate(_SANITIZE)
+        insert_columns.append(f"`{safe_key}`")
+        insert_values.append('%s')
+
+    # Assemble the query string
+    columns_str = ", ".join(insert_columns)
+    values_str = ", ".join(insert_values)
+
+    # Important: Backticks around table names to safely handle case sensitivity and special chars
+    return f"""
+    INSERT INTO `{table_name}` 
+        ({columns_str}) 
+    VALUES 
+        ({values_str})
+    """
+
+
+def get_insert_query(table_name, columns):
+    """
+    Returns the cached INSERT statement for a table and key set,
+    building it on first use.
+    """
+    query = STMT_CACHE.get((table_name, columns))
+    if query is None:
+        query = STMT_CACHE[(table_name, columns)] = build_insert_query(table_name, columns)
+    return query
+
+
+def to_json_text(value):
+    """Serializes lists/dicts to JSON text for TEXT columns."""
+    return orjson.dumps(value).decode("utf-8")
+
+
+def parse_message(topic, payload):
+    """
+    Parses a raw MQTT message into its table, column keys, sensor ID and data.
+
+    Args:
+        topic (str): The MQTT topic.
+        payload (bytes): The raw message payload.
+
+    Returns:
+        tuple or None: (table_name, columns, sensor_id, data),
+        or None if the payload is skipped.
+    """
+    # 1. Parse JSON directly from the payload bytes (Mandatory check)
+    try:
+        data = orjson.loads(payload)
+
+    except orjson.JSONDecodeError:
         # Skip log if payload is not valid JSON
-        print(f"[{topic}] Log skipped: Payload is not valid JSON.")
-        return
+        logger.warning("[%s] Log skipped: Payload is not valid JSON.", topic)
+        return None
     except Exception as e:
-        print(f"[{topic}] Log skipped: Error processing payload. {e}")
-        return
+        logger.warning("[%s] Log skipped: Error processing payload. %s", topic, e)
+        return None
 
-    table_name = topic_to_table_name(topic)
+    if not isinstance(data, dict):
+        # Skip valid JSON that is not an object (e.g. 42, "x", [1], null)
+        logger.warning("[%s] Log skipped: Payload is not a JSON object.", topic)
+        return None
 
     # 2. Extract 'id' and remove it from 'data' to treat it separately
     # Assumption: The sensor sends its ID under the key 'id'
     sensor_id = str(data.pop('id', 'UNKNOWN'))
 
+    # 3. Resolve table name and column order (cached per topic and key set)
+    signature = (topic, tuple(data))
+    schema = SCHEMA_CACHE.get(signature)
+    if schema is None:
+        schema = SCHEMA_CACHE[signature] = (topic_to_table_name(topic), tuple(sorted(data)))
+
+    return schema[0], schema[1], sensor_id, data
+
+
+def buffer_row(buffer, timestamp, table_name, columns, sensor_id, data):
+    """
+    Adds a parsed message to a worker's insert buffer.
+
+    Rows are grouped by table and key set, so every group maps to exactly
+    one INSERT statement.
+
+    Args:
+        buffer (dict): The worker's buffer, (table_name, keys) -> batch.
+        timestamp (datetime.datetime): The time the message was received.
+        table_name (str): The target table.
+        columns (tuple): The sorted JSON keys.
+        sensor_id (str): The sensor ID extracted from the payload.
+        data (dict): The remaining JSON data.
+
+    Returns:
+        int: The number of rows now buffered in this group.
+    """
+    batch = buffer.get((table_name, columns))
+    if batch is None:
+        # Keep the first message as sample to derive the schema from
+        batch = buffer[(table_name, columns)] = {"sample": data, "rows": []}
+
+    # Nested values (lists, dicts) are stored as JSON text, everything else
+    # is passed directly (handled by mysql.connector). Checked per value, as
+    # a key may be a scalar in one message and a list in the next.
+    values = tuple(
+        to_json_text(value) if isinstance(value, (list, dict)) else value
+        for value in (data[key] for key in columns)
+    )
+
+    batch["rows"].append((timestamp, sensor_id) + values)
+    return len(batch["rows"])
+
+
+def is_value_error(err):
+    """
+    Tells whether a database error was caused by a value in a row (too long,
+    out of range, wrong type, duplicate key) rather than by the statement,
+    the table or the connection.
+    """
+    return isinstance(err, (mysql.connector.errors.DataError, mysql.connector.errors.IntegrityError)) \
+        or err.errno in VALUE_ERRNOS
+
+
+def insert_rows(cursor, table_name, columns, rows):
+    """
+    Inserts one (table, keys) group with a single executemany() call.
+
+    One bad value rejects the whole multi-row INSERT, so on a value error the
+    rows are retried one at a time and only the rejected ones are dropped.
+    Any other error (e.g. missing table or column) would fail for every row,
+    so the group is dropped at once. Connection errors and deadlocks are re-raised.
+
+    Args:
+        cursor: The database cursor.
+        table_name (str): The target table.
+        columns (tuple): The sorted JSON keys.
+        rows (list): The parameter tuples to insert.
+    """
+    query = get_insert_query(table_name, columns)
+    try:
+        cursor.executemany(query, rows)
+        logger.debug(" -> Logged %d row(s) to '%s'.", len(rows), table_name)
+        return
+    except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError,
+            mysql.connector.errors.InternalError):
+        # Connection errors and deadlocks (1213, which roll back the whole
+        # transaction) fail the whole flush
+        raise
+    except mysql.connector.Error as err:
+        if len(rows) == 1 or not is_value_error(err):
+            logger.error(" -> Error logging to '%s', dropped %d row(s): %s", table_name, len(rows), err)
+            return
+
+    dropped = 0
+    last_error = None
+    for row in rows:
+        try:
+            cursor.execute(query, row)
+        except mysql.connector.Error as err:
+            if not is_value_error(err):
+                raise
+            dropped += 1
+            last_error = err
+
+    if dropped:
+        logger.error(" -> Error logging to '%s', dropped %d of %d row(s): %s",
+                     table_name, dropped, len(rows), last_error)
+    logger.debug(" -> Logged %d row(s) to '%s'.", len(rows) - dropped, table_name)
+
+
+def ensure_schema(cursor, table_name, data):
+    """
+    Makes sure a table exists and has a column for every key in data.
+
+    Once a table and its columns are cached this is a few set lookups without
+    any locking; otherwise CREATE/ALTER TABLE run under the table's own lock.
+
+    Args:
+        cursor: The database cursor.
+        table_name (str): The target table.
+        data (dict): The JSON data dictionary to derive the schema from.
+    """
+    known = TABLE_COLS.get(table_name)
+    if table_name in KNOWN_TABLES and known is not None and \
+            all(key.translate(_SANITIZE).lower() in known for key in data):
+        return
+
+    with SCHEMA_LOCK:
+        table_lock = TABLE_LOCKS.setdefault(table_name, threading.Lock())
+
+    with table_lock:
+        if table_name not in KNOWN_TABLES:
+            if create_dynamic_table(cursor, table_name, data):
+                KNOWN_TABLES.add(table_name)
+        if table_name in KNOWN_TABLES:
+            add_missing_columns(cursor, table_name, data)
+
+
+def flush_buffer(buffer):
+    """
+    Writes all rows of a worker's buffer to the database.
+
+    Each (table, keys) group is inserted with a single executemany() call.
+    The connection runs in autocommit mode, so a single group needs no
+    explicit transaction; several groups share one transaction and commit.
+
+    Args:
+        buffer (dict): The worker's buffer, (table_name, keys) -> batch.
+    """
+    if not buffer:
+        return
+
     db_conn = connect_db()
     if db_conn is None:
+        logger.error("Dropped %d buffered rows.", sum(len(b["rows"]) for b in buffer.values()))
         return
 
     cursor = None
+    use_transaction = False
     try:
         cursor = db_conn.cursor()
 
-        # 3. Table check and creation (if necessary)
-        if not table_exists(cursor, table_name):
-            # Creates the table based on the current data keys and types
-            create_dynamic_table(cursor, table_name, data)
-
-        # 4. Data Insertion (Dynamic INSERT)
-
-        # Base columns that are always present
-        insert_columns = ['timestamp', 'sensor_id']
-        insert_values = ['NOW()', '%s']
-        insert_data = [sensor_id]
-
-        # Add dynamic columns and values from the JSON payload
-        for key, value in data.items():
-            safe_key = key.replace('.', '_').replace('-', '_')
-            insert_columns.append(f"`{safe_key}`")
-            insert_values.append('%s')
-            insert_data.append(value)  # value is passed directly (handled by mysql.connector)
-
-        # Assemble the query string
-        columns_str = ", ".join(insert_columns)
-        values_str = ", ".join(insert_values)
-
-        # Important: Backticks around table names to safely handle case sensitivity and special chars
-        add_message = f"""
-        INSERT INTO `{table_name}` 
-            ({columns_str}) 
-        VALUES 
-            ({values_str})
-        """
-
-        cursor.execute(add_message, tuple(insert_data))
-        db_conn.commit()
-        print(f"[{topic}] -> Logged successfully to '{table_name}'.")
+        # 1. Table creation (if necessary), once per table, and columns for
+        # new JSON keys. Based on the first buffered message of each group.
+        # Runs before the transaction, as CREATE/ALTER TABLE commit implicitly.
+        for (table_name, columns), batch in buffer.items():
+            ensure_schema(cursor, table_name, batch["sample"])
+
+        # 2. Data Insertion
+        use_transaction = len(buffer) > 1
+        if use_transaction:
+            cursor.execute("START TRANSACTION")
+
+        for (table_name, columns), batch in buffer.items():
+            insert_rows(cursor, table_name, columns, batch["rows"])
+
+        if use_transaction:
+            cursor.execute("COMMIT")
 
     except mysql.connector.Error as err:
-        print(f"[{topic}] Error logging to MariaDB: {err}")
+        if use_transaction:
+            # Never return a connection with an open transaction to the pool
+            # (pool_reset_session=False); everything in this flush is undone
+            try:
+                db_conn.rollback()
+            except mysql.connector.Error:
+                pass
+            logger.error("Error flushing buffer to MariaDB, rolled back %d row(s): %s",
+                         sum(len(b["rows"]) for b in buffer.values()), err)
+        else:
+            logger.error("Error flushing buffer to MariaDB: %s", err)
     finally:
         if cursor:
             cursor.close()
         if db_conn:
+            # Returns the connection to the pool instead of closing it
             db_conn.close()
 
 
+def db_worker():
+    """
+    Worker thread: takes messages from MESSAGE_QUEUE, parses them and
+    writes them in batches. A None item flushes the buffer and stops the worker.
+    """
+    buffer = {}
+    next_flush = time.monotonic() + BATCH_INTERVAL
+
+    while True:
+        try:
+            item = MESSAGE_QUEUE.get(timeout=max(0.0, next_flush - time.monotonic()))
+        except queue.Empty:
+            item = ()
+
+        if item is None:
+            flush_buffer(buffer)
+            return
+
+        # Keep the worker alive on unexpected errors; a dead worker would
+        # silently stop draining the queue
+        try:
+            batch_full = False
+            if item:
+                topic, payload, received_at = item
+                parsed = parse_message(topic, payload)
+                if parsed is not None:
+                    # Naive UTC, matching the pool's session time_zone
+                    timestamp = datetime.datetime.fromtimestamp(
+                        received_at, datetime.timezone.utc).replace(tzinfo=None)
+                    batch_full = buffer_row(buffer, timestamp, *parsed) >= BATCH_SIZE
+
+            if batch_full or time.monotonic() >= next_flush:
+                try:
+                    flush_buffer(buffer)
+                finally:
+                    buffer = {}
+                    next_flush = time.monotonic() + BATCH_INTERVAL
+        except Exception:
+            logger.exception("Unexpected error in DB worker, continuing.")
+
+
+# --- MQTT Callbacks ---
+
+def tune_socket(sock):
+    """
+    Disables Nagle's algorithm on the broker socket for lower latency on small
+    packets (e.g. PUBACKs) and, if MQTT_SOCKET_RCVBUF is set, fixes the size
+    of its receive buffer.
+    """
+    if sock is None:
+        return
+    try:
+        if SOCKET_RCVBUF > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as err:
+        logger.warning("Could not tune MQTT socket: %s", err)
+
+
+def on_connect(client, userdata, flags, reason_code, properties):
+    """
+    Callback function when the client connects to the broker (Paho V2).
+    userdata holds the list of topic filters to subscribe to.
+    """
+    if reason_code == 0:
+        logger.info("Connected to MQTT Broker successfully.")
+        tune_socket(client.socket())
+        if flags.session_present:
+            logger.info("Resumed existing MQTT session.")
+        # Subscribe to this shard's topic filters (e.g., 'Sensoren/#'), passed as userdata.
+        # The session starts clean on process start, so only these filters are active.
+        for topic in userdata:
+            client.subscribe(topic, qos=MQTT_QOS)
+            logger.info("Subscribed to topic: %s (QoS %d)", topic, MQTT_QOS)
+    else:
+        logger.error("Failed to connect, return code %s", reason_code)
+
+
+def on_message(client, userdata, msg):
+    """
+    Callback function when a message is received.
+    Only enqueues the message; parsing and inserting happen in the DB workers.
+    """
+    global DROPPED_MESSAGES
+
+    try:
+        MESSAGE_QUEUE.put_nowait((msg.topic, msg.payload, time.time()))
+    except queue.Full:
+        DROPPED_MESSAGES += 1
+        # Only report every 1000th drop to keep logging off the network thread
+        if DROPPED_MESSAGES % 1000 == 1:
+            logger.warning("[%s] Log skipped: Queue is full (%d dropped so far).", msg.topic, DROPPED_MESSAGES)
+
+
 # --- Main Logic ---
 
-if __name__ == "__main__":
+def shard_subscriptions(shard, shard_count):
+    """
+    Returns the topic filters a shard subscribes to.
+
+    MQTT_TOPIC_SUBSCRIPTION may list several comma-separated filters. With
+    MQTT_SHARE_GROUP set, every shard subscribes to all filters as a shared
+    subscription ('$share/<group>/<filter>') and the broker balances messages
+    between the shards. Otherwise the filters are split between the shards.
+
+    Args:
+        shard (int): Index of this shard.
+        shard_count (int): Total number of shards.
+
+    Returns:
+        list: The topic filters for this shard (may be empty).
+    """
+    topics = [t.strip() for t in CONFIG["MQTT_TOPIC_SUBSCRIPTION"].split(",") if t.strip()]
+    if shard_count == 1:
+        return topics
+
+    group = CONFIG.get("MQTT_SHARE_GROUP")
+    if group:
+        return [f"$share/{group}/{topic}" for topic in topics]
+    return topics[shard::shard_count]
+
+
+def run_logger(shard=0, shard_count=1):
+    """
+    Runs one logger instance: its own DB pool, DB workers and MQTT client.
+    With MQTT_SHARDS > 1, each shard runs this in its own process.
+
+    Args:
+        shard (int): Index of this shard.
+        shard_count (int): Total number of shards.
+
+    Returns:
+        int: The exit code.
+    """
+    global DB_POOL
+
+    log_listener = setup_logging(show_process=shard_count > 1)
+
+    topics = shard_subscriptions(shard, shard_count)
+    if not topics:
+        logger.warning("No topic filter left for this shard, set MQTT_SHARE_GROUP or list more filters.")
+        log_listener.stop()
+        return 0
+
+    # 0. Database Connection Pool
+    DB_POOL = create_db_pool()
+    if DB_POOL is None:
+        log_listener.stop()
+        return 1
+    load_known_tables()
 
     # 1. MQTT Client Setup (Paho V2 API)
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    # MQTT v5 with a fixed client ID: the session (subscriptions and queued QoS>0
+    # messages) is kept on the broker across reconnects, but started clean on
+    # process start (see connect below), so old filters never linger
+    client_id = CONFIG.get("MQTT_CLIENT_ID") or "mqtt2mariadb"
+    if shard_count > 1:
+        client_id = f"{client_id}-{shard}"
+    client = mqtt.Client(
+        mqtt.CallbackAPIVersion.VERSION2,
+        client_id=client_id,
+        protocol=mqtt.MQTTv5,
+        userdata=topics
+    )
     client.on_connect = on_connect
     client.on_message = on_message
 
+    # Back off between 1 and 30 seconds when the broker connection drops
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+
     # 2. Handle SSL/TLS
     if CONFIG.get("MQTT_USE_SSL", "false").lower() == "true":
-        print("Attempting connection with SSL/TLS.")
+        logger.info("Attempting connection with SSL/TLS.")
         client.tls_set(tls_version=ssl.PROTOCOL_TLS_CLIENT)
 
     # 3. Handle Credentials
@@ -258,20 +811,96 @@ if __name__ == "__main__":
     mqtt_host = CONFIG["MQTT_BROKER_HOST"]
     mqtt_port = int(CONFIG["MQTT_BROKER_PORT"])
 
-    print(f"Connecting to MQTT broker at {mqtt_host}:{mqtt_port}...")
+    logger.info("Connecting to MQTT broker at %s:%d...", mqtt_host, mqtt_port)
     try:
-        client.connect(mqtt_host, mqtt_port, 60)
+        # The broker drops the session SESSION_EXPIRY seconds after a disconnect,
+        # so sessions of removed client IDs (e.g. old shards) do not pile up
+        connect_properties = Properties(PacketTypes.CONNECT)
+        connect_properties.SessionExpiryInterval = SESSION_EXPIRY
+        client.connect(
+            mqtt_host, mqtt_port, 60,
+            clean_start=mqtt.MQTT_CLEAN_START_FIRST_ONLY,
+            properties=connect_properties
+        )
     except Exception as e:
-        print(f"Could not connect to MQTT Broker: {e}")
-        exit(1)
+        logger.error("Could not connect to MQTT Broker: %s", e)
+        log_listener.stop()
+        return 1
+
+    # 5. Start the DB worker threads
+    workers = [threading.Thread(target=db_worker, daemon=True) for _ in range(DB_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    # SIGTERM (systemctl stop/restart) disconnects the client, so loop_forever()
+    # returns and the workers flush like on Ctrl+C
+    terminated = threading.Event()
+
+    def on_sigterm(signum, frame):
+        terminated.set()
+        client.disconnect()
 
-    # 5. Start the Loop
-    print("Starting MQTT listener loop...")
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    # 6. Start the Loop
+    logger.info("Starting MQTT listener loop...")
     try:
         client.loop_forever()
     except KeyboardInterrupt:
-        print("\nProgram terminated by user.")
+        logger.info("Program terminated by user.")
     except Exception as e:
-        print(f"\nAn unexpected error occurred in the main loop: {e}")
+        logger.error("An unexpected error occurred in the main loop: %s", e)
+    if terminated.is_set():
+        logger.info("Program terminated by SIGTERM.")
+
+    # Let the workers write out whatever is still queued or buffered
+    for worker in workers:
+        MESSAGE_QUEUE.put(None)
+    for worker in workers:
+        worker.join()
+
+    logger.info("Program finished.")
+    log_listener.stop()
+    return 0
 
-    print("Program finished.")
\ No newline at end of file
+
+def run_shard(shard, shard_count):
+    """Process target for a shard; exits with run_logger's exit code."""
+    sys.exit(run_logger(shard, shard_count))
+
+
+if __name__ == "__main__":
+
+    shard_count = int(CONFIG.get("MQTT_SHARDS", 1))
+
+    if shard_count <= 1:
+        exit(run_logger())
+
+    # One process per shard: separate MQTT client, DB pool and interpreter (no shared GIL)
+    processes = [
+        multiprocessing.Process(target=run_shard, args=(shard, shard_count), name=f"shard-{shard}")
+        for shard in range(shard_count)
+    ]
+    for process in processes:
+        process.start()
+
+    # Forward SIGTERM to the shards, which then flush and exit on their own
+    def forward_sigterm(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward_sigterm)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Ctrl+C also reaches the shards, which flush and exit on their own
+        for process in processes:
+            process.join()
+
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        logger.error("Shard(s) exited with an error: %s", ", ".join(failed))
+        exit(1)